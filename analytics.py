@@ -3,9 +3,12 @@
 '''
 
 import argparse
+import functools
 import logging
 import networkx as nx
 import sys
+from joblib import Parallel, delayed
+from networkx.readwrite.graphml import write_graphml_lxml
 from store import AnalyticsFlowStore, DatabaseSettings
 
 # Rough and ready logging
@@ -25,6 +28,7 @@ class FlowFinder:
 
     store = None
     logger = None
+    output_format = None
 
     INTERESTING_PROTOCOLS = [
         (6, 22, 'SSH'),
@@ -34,73 +38,104 @@ class FlowFinder:
         (6, 5986, 'WinRM (TLS)')
     ]
 
-    def __init__(self, logger, database_settings):
+    def __init__(self, logger, database_settings, output_format='graphml'):
         '''
             Creates a new instance of the flow finder.
         '''
 
         self.logger = logger
         self.store = AnalyticsFlowStore(logger, database_settings)
+        self.output_format = output_format
 
-    def _find_child_flows(self, parent, graph, start, end, seen_nodes):
+    def _write_graph(self, graph, base_name):
         '''
-            Attempts to find child flows and add them to our graph.
+            Writes a graph out in the configured format. GraphML is the
+            interoperable default; pickle and (gzipped) edge lists are
+            much smaller and faster when the consumer is another script.
         '''
 
-        # Check we've not already been visited
-        # Make a note so we don't loop ;)
-
-        if (parent in seen_nodes):
-            return
+        if self.output_format == 'pickle':
+            nx.write_gpickle(graph, f"{base_name}.gpickle")
+        elif self.output_format == 'edgelist':
+            nx.write_edgelist(graph, f"{base_name}.edgelist.gz", data=['object'])
         else:
-            seen_nodes.add(parent)
+            write_graphml_lxml(graph, f"{base_name}.graphml")
+
+    @functools.lru_cache(maxsize=100_000)
+    def _walk_tree_cached(self, protocol, port, root, start):
+        '''
+            Caches tree walks for a single build_graphs run; the same
+            (protocol, port, root) can crop up under many starting flows.
+            Plain tuples, not ORM rows, so entries stay cheap to hold.
+        '''
+
+        return tuple(
+            (source, destination)
+            for source, destination in self.store.walk_tree(protocol, port, root, start)
+        )
 
-        # Perform the search
+    def _find_child_flows(self, parent, graph, start):
+        '''
+            Attempts to find child flows and add them to our graph.
+
+            The whole tree walk happens in the database as a recursive
+            query, so we get the edge set back in one round trip per
+            protocol. The depth cap in the store handles cycles for us.
+        '''
 
         for protocol, port, label in self.INTERESTING_PROTOCOLS:
             logger.info(f"Attempting to find child flows matching protocol {protocol} port {port} on {parent}.")
-            for flow in self.store.get_interseting_flows_deep(protocol, port, parent, start, end):
+            edges = self._walk_tree_cached(protocol, port, parent, start)
+            logger.debug(f"Found {len(edges)} child flow edge(s) for {parent}.")
+            graph.add_edges_from(
+                (source, destination, {'object': label})
+                for source, destination in edges
+            )
+
+    def _build_one_graph(self, flow, label):
+        '''
+            Builds, walks and writes out the graph for a single root flow.
+        '''
+
+        # Start building our graph with our root node
 
-                # Add the child flows to the graph
+        logger.debug(f"Found starting flow: {flow}")
+        graph = nx.Graph()
+        graph.add_nodes_from([flow.source_address, flow.destination_address])
+        graph.add_edge(flow.source_address, flow.destination_address, object=label)
 
-                logger.debug(f"Found child flow for {parent}: {flow}")
-                graph.add_nodes_from([flow.source_address, flow.destination_address])
-                graph.add_edge(flow.source_address, flow.destination_address, object=label)
+        # Work our way down the children finding more matches
 
-                # Iterate down
+        self._find_child_flows(flow.destination_address, graph, flow.start)
 
-                self._find_child_flows(flow.destination_address, graph, start, end, seen_nodes)
+        # Punt our graph out
+
+        self._write_graph(graph, f"{flow.source_address}_{flow.destination_address}_{flow.destination_port}_{flow.protocol}_{flow.start.timestamp()}")
+        return graph
 
     def build_graphs(self):
         '''
             Builds the interesting flow graphs.
+
+            Each root flow's subtree is independent, so the walks run on a
+            thread pool. The hot wait is database I/O, which releases the
+            GIL, so threads give us real overlap without process overhead.
         '''
 
         graphs = []
 
-        for protocol, port, label in self.INTERESTING_PROTOCOLS:
-            logger.info(f"Attempting to find flows matching protocol {protocol} port {port}...")
-            for flow in self.store.get_interseting_flows(protocol, port):
-
-                # Make a note of the nodes we've seen
-
-                logger.debug(f"Found starting flow: {flow}")
-                seen_nodes = {flow.source_address}
-
-                # Start building our graph with our root node
+        # Start each run with a fresh cache so we don't serve stale walks
 
-                graph = nx.Graph()
-                graph.add_nodes_from([flow.source_address, flow.destination_address])
-                graph.add_edge(flow.source_address, flow.destination_address, object=label)
+        self._walk_tree_cached.cache_clear()
 
-                # Work our way down the children finding more matches
-
-                self._find_child_flows(flow.destination_address, graph, flow.start, flow.end, seen_nodes)
-
-                # Punt our graph out
-
-                nx.write_graphml(graph, f"{flow.source_address}_{flow.destination_address}_{flow.destination_port}_{flow.protocol}_{flow.start.timestamp()}.graphml")
-                graphs.append(graph)
+        for protocol, port, label in self.INTERESTING_PROTOCOLS:
+            logger.info(f"Attempting to find flows matching protocol {protocol} port {port}...")
+            graphs.extend(
+                Parallel(n_jobs=-1, backend='threading')(
+                    delayed(self._build_one_graph)(flow, label)
+                    for flow in self.store.get_interseting_flows(protocol, port)
+                )
+            )
 
         return graphs
             
@@ -111,6 +146,7 @@ class Analytics:
     '''
 
     database_settings = None
+    output_format = None
     finder = None
 
     def _check_port(self, value):
@@ -161,8 +197,15 @@ class Analytics:
             help='The database to use on the SQL server.',
             required=True
         )
+        parser.add_argument(
+            '--format',
+            choices=['graphml', 'pickle', 'edgelist'],
+            default='graphml',
+            help='The file format to write the graphs out in.'
+        )
 
         args = parser.parse_args()
+        self.output_format = args.format
         self.database_settings = DatabaseSettings(
             args.sql_server,
             args.sql_port,
@@ -182,7 +225,7 @@ class Analytics:
 
         # Setup our flow finder
 
-        self.finder = FlowFinder(logger, self.database_settings)
+        self.finder = FlowFinder(logger, self.database_settings, self.output_format)
 
     def run(self):
         '''
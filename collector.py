@@ -4,12 +4,15 @@
 '''
 
 import argparse
+import asyncio
+import functools
 import netflow
 import ipaddress
 import logging
-import queue
+import numpy as np
+import pickle
 import socket
-import socketserver
+import struct
 import sys
 import threading
 import time
@@ -17,7 +20,74 @@ from collections import namedtuple
 from datetime import datetime
 from store import Flow, InboundFlowStore, DatabaseSettings
 
-RawPacket = namedtuple('RawPacket', ['ts', 'client', 'data'])
+RawPacket = namedtuple('RawPacket', ['ts', 'client', 'data', 'needed_template_ids'], defaults=[frozenset()])
+
+# Addresses repeat heavily across flows, so cache the (surprisingly
+# expensive) parse and validation in ipaddress
+
+ip_address_cached = functools.lru_cache(maxsize=65536)(ipaddress.ip_address)
+
+def format_address(value):
+    '''
+        Formats a raw NetFlow address as a string. Integer and packed
+        byte addresses (as IPFIX decoding produces) go through the thin
+        C helpers in socket; anything else - including the v9 parser's
+        already-formatted strings - falls back to the cached ipaddress
+        parse.
+    '''
+
+    if isinstance(value, int):
+        if value < 2 ** 32:
+            return socket.inet_ntop(socket.AF_INET, struct.pack('>I', value))
+        return socket.inet_ntop(socket.AF_INET6, value.to_bytes(16, 'big'))
+
+    if isinstance(value, (bytes, bytearray)) and len(value) == 16:
+        return socket.inet_ntop(socket.AF_INET6, value)
+
+    return str(ip_address_cached(value))
+
+def needed_template_ids(data):
+    '''
+        Pulls the data flowset IDs out of a raw v9/IPFIX packet; these
+        are the template IDs the packet needs before it can be parsed.
+        The parser doesn't surface them when it raises, so we read the
+        flowset headers ourselves. Returns an empty set if the packet
+        doesn't look like either format.
+    '''
+
+    try:
+        (version,) = struct.unpack('!H', data[:2])
+    except struct.error:
+        return frozenset()
+
+    # Flowsets start after the 20 byte v9 / 16 byte IPFIX header
+
+    if version == 9:
+        offset = 20
+    elif version == 10:
+        offset = 16
+    else:
+        return frozenset()
+
+    template_ids = set()
+
+    while offset + 4 <= len(data):
+        set_id, length = struct.unpack('!HH', data[offset:offset + 4])
+
+        # A zero length would loop forever on a malformed packet
+
+        if length < 4:
+            break
+
+        # IDs from 256 up are data flowsets referencing a template
+
+        if set_id >= 256:
+            template_ids.add(set_id)
+
+        offset += length
+
+    return frozenset(template_ids)
+
 logger = logging.getLogger("collector")
 logger.setLevel(logging.DEBUG)
 
@@ -25,25 +95,19 @@ handler = logging.StreamHandler(sys.stdout)
 handler.setLevel(logging.DEBUG)
 logger.addHandler(handler)
 
-class QueuingRequestHandler(socketserver.BaseRequestHandler):
-    def handle(self):
-        data = self.request[0]
-        self.server.queue.put(RawPacket(time.time(), self.client_address, data))
-        (address, port) = self.client_address
-        logger.info(f"Received {len(data)} bytes of data from {address}:{port}")
-
-
-class QueuingUDPListener(socketserver.ThreadingUDPServer):
-    """A threaded UDP server that adds a (time, data) tuple to a queue for
-    every request it sees
+class NetflowProtocol(asyncio.DatagramProtocol):
+    """A datagram protocol that adds a (time, data) tuple to a queue for
+    every packet it sees. One event loop thread handles every datagram,
+    rather than the thread-per-request model of socketserver.
     """
 
-    def __init__(self, interface, queue):
+    def __init__(self, queue):
         self.queue = queue
-        if ":" in interface[0]:
-            self.address_family = socket.AF_INET6
 
-        super().__init__(interface, QueuingRequestHandler)
+    def datagram_received(self, data, addr):
+        self.queue.put_nowait(RawPacket(time.time(), addr, data))
+        (address, port) = addr
+        logger.info(f"Received {len(data)} bytes of data from {address}:{port}")
 
 class Collector(threading.Thread):
     '''
@@ -52,8 +116,8 @@ class Collector(threading.Thread):
 
     port = 0
     input = None
-    server = None
     TIMEOUT = 3600
+    TEMPLATE_CACHE_PATH = 'templates.cache'
     PROTOCOL_MAP = {
         1: 'ICMP',
         2: 'IGMP',
@@ -61,6 +125,18 @@ class Collector(threading.Thread):
         17: 'UDP',
         58: 'IPv6-ICMP'
     }
+
+    # Column layout for the IPv4 fast path; the parser hands addresses
+    # over already formatted as strings, so only the numeric fields
+    # go columnar
+
+    IPV4_FLOW_DTYPE = np.dtype([
+        ('proto', 'u1'),
+        ('sport', 'u2'),
+        ('dport', 'u2'),
+        ('first', 'u4'),
+        ('last', 'u4')
+    ])
     database_settings = None
     store = None
 
@@ -136,13 +212,10 @@ class Collector(threading.Thread):
         '''
 
         # Setup the collector
+        # The listener itself is created on the event loop in run()
 
         self._parse_command_line()
-        self.input = queue.Queue()
-        self.server = QueuingUDPListener(('0.0.0.0', self.port), self.input)
-        self.thread = threading.Thread(target=self.server.serve_forever)
-        self.thread.start()
-        self._shutdown = threading.Event()
+        self.input = None
 
         # Setup our store
 
@@ -156,76 +229,150 @@ class Collector(threading.Thread):
             Changes a protocol number into a friendly string
         '''
 
-        if protocol in self.PROTOCOL_MAP.keys():
-            return self.PROTOCOL_MAP[protocol]
-        else:
-            return protocol
+        return self.PROTOCOL_MAP.get(protocol, protocol)
 
-    def _process_export(self, export):
+    def _queue_flow(self, src_ip, dst_ip, protocol, src_port, dst_port, start_time, end_time):
         '''
-            Processess a frame exported to our collector
+            Pushes a single parsed flow onto the storage queue
         '''
 
-        # Calculate the boot time (used for flow start/end)
+        logger.info(f'{src_ip}:{src_port} -> {dst_ip}:{dst_port} [{self._protocol_to_friendly(protocol)}] {start_time} -> {end_time}')
 
-        boot_time = export.header.timestamp - export.header.uptime
+        db_flow = Flow()
+        db_flow.source_address = src_ip
+        db_flow.destination_address = dst_ip
+        db_flow.protocol = protocol
+        db_flow.source_port = src_port
+        db_flow.destination_port = dst_port
+        db_flow.start = start_time
+        db_flow.end = end_time
 
-        # Process the child flows
+        logger.debug(db_flow)
+        self.store.queue.put(db_flow)
 
-        for flow in export.flows:
-                #print(flow)
+    def _process_export(self, export):
+        '''
+            Processess a frame exported to our collector
+        '''
 
-                # Pull out our source and destination
+        # Calculate the boot time (used for flow start/end)
 
-                if not hasattr(flow, 'IP_PROTOCOL_VERSION') or flow.IP_PROTOCOL_VERSION is 4:
-                    src_ip = str(ipaddress.ip_address(flow.IPV4_SRC_ADDR))
-                    dst_ip = str(ipaddress.ip_address(flow.IPV4_DST_ADDR))
-                else:
-                    src_ip = str(ipaddress.ip_address(flow.IPV6_SRC_ADDR))
-                    dst_ip = str(ipaddress.ip_address(flow.IPV6_DST_ADDR))
+        boot_time = export.header.timestamp - export.header.uptime
 
-                # Calculate the flow start time
+        # Bind the hot lookups to locals so the per-flow loops skip
+        # repeated attribute and global resolution
 
-                start_time = datetime.fromtimestamp(flow.FIRST_SWITCHED + boot_time)
-                end_time = datetime.fromtimestamp(flow.LAST_SWITCHED + boot_time)
+        queue_flow = self._queue_flow
+        fromtimestamp = datetime.utcfromtimestamp
+        format_addr = format_address
 
-                # Shunt to storage
+        # Split the export into the (overwhelmingly common) IPv4 flows,
+        # which we can process column-wise, and everything else
 
-                logger.info(f'{src_ip}:{flow.L4_SRC_PORT} -> {dst_ip}:{flow.L4_DST_PORT} [{self._protocol_to_friendly(flow.PROTOCOL)}] {start_time} -> {end_time}')
+        ipv4_flows = []
+        other_flows = []
 
-                db_flow = Flow()
-                db_flow.source_address = src_ip
-                db_flow.destination_address = dst_ip
-                db_flow.protocol = flow.PROTOCOL
-                db_flow.source_port = flow.L4_SRC_PORT
-                db_flow.destination_port = flow.L4_DST_PORT
-                db_flow.start = start_time
-                db_flow.end = end_time
+        for flow in export.flows:
+            if not hasattr(flow, 'IP_PROTOCOL_VERSION') or flow.IP_PROTOCOL_VERSION == 4:
+                ipv4_flows.append(flow)
+            else:
+                other_flows.append(flow)
+
+        # One Python loop to fill the columns, then the timestamp
+        # conversions happen in bulk rather than per attribute; the
+        # addresses come out of the parser as strings, so they pass
+        # straight through
+
+        if ipv4_flows:
+            columns = np.empty(len(ipv4_flows), dtype=self.IPV4_FLOW_DTYPE)
+            src_ips = []
+            dst_ips = []
+
+            for index, flow in enumerate(ipv4_flows):
+                columns[index] = (
+                    flow.PROTOCOL,
+                    flow.L4_SRC_PORT,
+                    flow.L4_DST_PORT,
+                    flow.FIRST_SWITCHED,
+                    flow.LAST_SWITCHED
+                )
+                src_ips.append(flow.IPV4_SRC_ADDR)
+                dst_ips.append(flow.IPV4_DST_ADDR)
+
+            start_times = (columns['first'].astype('i8') + boot_time).astype('datetime64[s]').tolist()
+            end_times = (columns['last'].astype('i8') + boot_time).astype('datetime64[s]').tolist()
+
+            for index in range(len(ipv4_flows)):
+                queue_flow(
+                    src_ips[index],
+                    dst_ips[index],
+                    int(columns['proto'][index]),
+                    int(columns['sport'][index]),
+                    int(columns['dport'][index]),
+                    start_times[index],
+                    end_times[index]
+                )
+
+        # Anything else (IPv6) takes the scalar path
+
+        for flow in other_flows:
+            queue_flow(
+                format_addr(flow.IPV6_SRC_ADDR),
+                format_addr(flow.IPV6_DST_ADDR),
+                flow.PROTOCOL,
+                flow.L4_SRC_PORT,
+                flow.L4_DST_PORT,
+                fromtimestamp(flow.FIRST_SWITCHED + boot_time),
+                fromtimestamp(flow.LAST_SWITCHED + boot_time)
+            )
 
-                logger.debug(db_flow)
-                self.store.queue.put(db_flow)
-        
 
     def run(self):
         '''
             Runs the collector
         '''
 
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(self._consume(loop))
+
+    async def _consume(self, loop):
+        '''
+            Listens for packets on the event loop and processes them
+        '''
+
+        # A single socket on the event loop; no per-packet threads
+
+        self.input = asyncio.Queue()
+        await loop.create_datagram_endpoint(
+            lambda: NetflowProtocol(self.input),
+            local_addr=('0.0.0.0', self.port)
+        )
+
         # Templates we build out from the NetFlow v9 or IPFIX source
 
         templates = {"netflow": {} , "ipfix": {}}
         to_retry = []
 
+        # Warm the templates back up from the last run, if we have them,
+        # so we don't sit re-queueing packets until they arrive again
+
+        try:
+            with open(self.TEMPLATE_CACHE_PATH, 'rb') as cache_file:
+                templates = pickle.load(cache_file)
+            logger.info("Loaded cached templates from disk.")
+        except (OSError, pickle.PickleError):
+            logger.info("No cached templates found. Starting cold.")
+
+        known_templates = set(templates['netflow']) | set(templates['ipfix'])
+
         # Process packets forever
 
         while True:
 
             # Read from the input queue
 
-            try:
-                payload = self.input.get(block=True, timeout=0.5)
-            except queue.Empty:
-                continue
+            payload = await self.input.get()
 
             try:
                 export = netflow.parse_packet(payload.data, templates)
@@ -236,7 +383,11 @@ class Collector(threading.Thread):
                 if (time.time() - payload.ts) > self.TIMEOUT:
                     logger.error("Dropping timed out packet.")
                 else:
-                    to_retry.append(payload)
+
+                    # Tag the payload with the templates it's waiting on
+                    # so we only retry it once they actually turn up
+
+                    to_retry.append(payload._replace(needed_template_ids=needed_template_ids(payload.data)))
                     logger.warning("Adding to queue to retry later (as templates update).")
                 continue
 
@@ -246,12 +397,42 @@ class Collector(threading.Thread):
 
             # Look for templates to re-process flows with
 
-            if export.header.version in [9, 10] and export.contains_new_templates and to_retry:
-                logger.info(f"New templates recieved! Reprocessing {len(to_retry)} frames.")
+            if export.header.version in [9, 10] and export.contains_new_templates:
+
+                # Persist the templates so the next run starts warm
+
+                with open(self.TEMPLATE_CACHE_PATH, 'wb') as cache_file:
+                    pickle.dump(templates, cache_file)
+
+                # Refresh what we know and only re-parse the payloads
+                # whose data flowsets are all covered by a template now
+
+                known_templates = set(templates['netflow']) | set(templates['ipfix'])
+
+                still_waiting = []
+                reprocessed = 0
+
                 for retry_payload in to_retry:
-                    retry_export = netflow.parse_packet(retry_payload.data, templates)
+                    if retry_payload.needed_template_ids and not retry_payload.needed_template_ids <= known_templates:
+                        still_waiting.append(retry_payload)
+                        continue
+
+                    # Re-announced templates also look "new" to the
+                    # parser, so guard against a still-missing template
+
+                    try:
+                        retry_export = netflow.parse_packet(retry_payload.data, templates)
+                    except (netflow.v9.V9TemplateNotRecognized, netflow.ipfix.IPFIXTemplateNotRecognized):
+                        still_waiting.append(retry_payload)
+                        continue
+
                     self._process_export(retry_export)
-                to_retry.clear()
+                    reprocessed += 1
+
+                if reprocessed:
+                    logger.info(f"New templates recieved! Reprocessed {reprocessed} frames.")
+
+                to_retry = still_waiting
 
 if __name__ == "__main__":
     Collector().start()
\ No newline at end of file
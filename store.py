@@ -4,11 +4,12 @@
 
 import queue
 import threading
+import time
 import uuid
-from sqlalchemy import Column, Integer, DateTime, create_engine, or_, and_, MetaData
+from psycopg2.extras import execute_values
+from sqlalchemy import Column, Index, Integer, DateTime, create_engine, and_, select, text, MetaData
 from sqlalchemy.dialects.postgresql import UUID, INET
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
 from urllib.parse import quote
 
 Base = declarative_base()
@@ -20,6 +21,13 @@ class Flow(Base):
 
     __tablename__ = 'flows'
 
+    # Indexes to keep the analytics queries and the dedupe lookup off seq scans
+
+    __table_args__ = (
+        Index('ix_flow_proto_dport_src_start', 'protocol', 'destination_port', 'source_address', 'start'),
+        Index('ix_flow_dedupe', 'source_address', 'destination_address', 'source_port', 'destination_port', 'protocol', 'start', unique=True)
+    )
+
     id = Column(
         UUID(as_uuid=True),
         primary_key=True,
@@ -65,15 +73,63 @@ class DatabaseSettings:
         self.password = password
         self.database = database
 
+# One engine (and so one connection pool) per database, shared by every
+# store in the process
+
+_engines = {}
+
+def get_engine(database_settings):
+    '''
+        Returns the shared engine for a set of database settings,
+        creating it on first use.
+    '''
+
+    key = (
+        database_settings.server,
+        database_settings.port,
+        database_settings.username,
+        database_settings.database
+    )
+
+    if key not in _engines:
+        _engines[key] = create_engine(
+            f"postgresql+psycopg2://{database_settings.username}:{quote(database_settings.password)}@{database_settings.server}:{database_settings.port}/{database_settings.database}",
+            echo=False,
+            pool_size=8,
+            max_overflow=16,
+            pool_pre_ping=True,
+            executemany_mode='values'
+        )
+
+    return _engines[key]
+
 class InboundFlowStore(threading.Thread):
     '''
         Store for handling inbound flows.
     '''
 
     queue = None
-    session = None
+    engine = None
     logger = None
 
+    # Straight to psycopg2: one multi-row statement per batch, no ORM
+    # unit-of-work or per-row parameter binding
+
+    UPSERT_SQL = '''
+        INSERT INTO flows (id, source_address, destination_address, source_port, destination_port, protocol, start, "end")
+        VALUES %s
+        ON CONFLICT (source_address, destination_address, source_port, destination_port, protocol, start)
+        DO UPDATE SET "end" = EXCLUDED."end"
+    '''
+
+    # Flush once we've buffered this many flows...
+
+    BATCH_SIZE = 500
+
+    # ... or this many seconds after the first one arrived
+
+    BATCH_TIMEOUT = 0.1
+
     def __init__(self, logger, database_settings):
 
         # Setup the inbound queue and logging
@@ -83,16 +139,74 @@ class InboundFlowStore(threading.Thread):
 
         # Connect to the database
 
-        engine = create_engine(
-            f"postgres://{database_settings.username}:{quote(database_settings.password)}@{database_settings.server}:{database_settings.port}/{database_settings.database}",
-            echo=False
-        )
+        self.engine = get_engine(database_settings)
 
-        SessionBase = sessionmaker(bind=engine)
-        self.session = SessionBase()
+        # Make sure the table and indexes exist before we start writing
+
+        Base.metadata.create_all(self.engine)
 
         super().__init__()
 
+    def _store_batch(self, batch):
+        '''
+            Upserts a whole batch of flows in one statement and one commit.
+        '''
+
+        deduped = {}
+
+        for flow in batch:
+
+            # Canonicalise the direction so the reply leg lands on the
+            # same row (this replaces the old OR-of-both-directions check)
+
+            if flow.destination_address < flow.source_address:
+                flow.source_address, flow.destination_address = flow.destination_address, flow.source_address
+                flow.source_port, flow.destination_port = flow.destination_port, flow.source_port
+
+            # Collapse rows sharing the conflict key (both legs of one
+            # connection routinely land in the same batch), keeping the
+            # latest end time; Postgres rejects a multi-row upsert that
+            # touches the same row twice
+
+            key = (
+                flow.source_address,
+                flow.destination_address,
+                flow.source_port,
+                flow.destination_port,
+                flow.protocol,
+                flow.start
+            )
+
+            if key not in deduped or flow.end > deduped[key].end:
+                deduped[key] = flow
+
+        rows = [
+            (
+                str(uuid.uuid4()),
+                flow.source_address,
+                flow.destination_address,
+                flow.source_port,
+                flow.destination_port,
+                flow.protocol,
+                flow.start,
+                flow.end
+            )
+            for flow in deduped.values()
+        ]
+
+        # Insert, or bump the end time on conflict
+
+        connection = self.engine.raw_connection()
+
+        try:
+            with connection.cursor() as cursor:
+                execute_values(cursor, self.UPSERT_SQL, rows, page_size=500)
+            connection.commit()
+        finally:
+            connection.close()
+
+        self.logger.debug(f"Stored a batch of {len(rows)} flow(s).")
+
     def run(self):
 
         # Run forever
@@ -106,43 +220,41 @@ class InboundFlowStore(threading.Thread):
             except queue.Empty:
                 continue
 
-            # Check for an existing flow to update
-
-            for existing_flow in self.session.query(Flow).filter(
-                or_(
-                    and_(
-                        Flow.source_address == flow.source_address,
-                        Flow.destination_address == flow.destination_address,
-                        Flow.source_port == flow.source_port,
-                        Flow.destination_port == flow.destination_port,
-                        Flow.protocol == flow.protocol,
-                        Flow.start == flow.start
-                    ),
-                    and_(
-                        Flow.source_address == flow.destination_address,
-                        Flow.destination_address == flow.source_address,
-                        Flow.source_port == flow.destination_port,
-                        Flow.destination_port == flow.source_port,
-                        Flow.protocol == flow.protocol,
-                        Flow.start == flow.start
-                    )
-                )
-            ):
-                existing_flow.end = flow.end
-                self.logger.debug(f"Updated flow {existing_flow.source_address} -> {existing_flow.destination_address}:{existing_flow.destination_port}")
-                self.session.commit()
-                continue
+            # Drain the queue into a bounded buffer, flushing when it
+            # fills up or the first flow has sat around long enough
 
-            # Write our new flow back to the database
+            batch = [flow]
+            first_seen = time.monotonic()
 
-            self.session.add(flow)
-            self.logger.debug(f"Created flow {flow.source_address} -> {flow.destination_address}:{flow.destination_port}")
-            self.session.commit()
+            while len(batch) < self.BATCH_SIZE:
+                remaining = self.BATCH_TIMEOUT - (time.monotonic() - first_seen)
+
+                if remaining <= 0:
+                    break
+
+                try:
+                    batch.append(self.queue.get(block=True, timeout=remaining))
+                except queue.Empty:
+                    break
+
+            self._store_batch(batch)
 
 class AnalyticsFlowStore:
 
     logger = None
-    session = None
+    engine = None
+
+    # The only columns the analytics read; plain Core rows skip the ORM
+    # identity map and per-attribute hydration entirely
+
+    FLOW_COLUMNS = [
+        Flow.__table__.c.source_address,
+        Flow.__table__.c.destination_address,
+        Flow.__table__.c.start,
+        Flow.__table__.c.end,
+        Flow.__table__.c.destination_port,
+        Flow.__table__.c.protocol
+    ]
 
     def __init__(self, logger, database_settings):
         '''
@@ -152,38 +264,65 @@ class AnalyticsFlowStore:
         self.logger = logger
 
         # Connect to the database
+        # Connections come from the engine pool, so parallel walks are safe
 
-        engine = create_engine(
-            f"postgres://{database_settings.username}:{quote(database_settings.password)}@{database_settings.server}:{database_settings.port}/{database_settings.database}",
-            echo=False
-        )
-
-        SessionBase = sessionmaker(bind=engine)
-        self.session = SessionBase()
+        self.engine = get_engine(database_settings)
 
     def get_interseting_flows(self, protocol, port):
         '''
             The initial (wide) search for interesting flows.
+
+            Streams plain row tuples from a server-side cursor so we don't
+            hold the whole result set (or ORM objects) in memory.
         '''
 
-        return self.session.query(Flow).filter(
-            and_(
-                Flow.protocol == protocol,
-                Flow.destination_port == port
-            )
+        return self.engine.execute(
+            select(self.FLOW_COLUMNS).where(
+                and_(
+                    Flow.__table__.c.protocol == protocol,
+                    Flow.__table__.c.destination_port == port
+                )
+            ).execution_options(stream_results=True)
         )
 
-    def get_interseting_flows_deep(self, protocol, port, source_address, start, end):
+    # Stops the recursive walk chasing cycles forever
+
+    MAX_WALK_DEPTH = 32
+
+    WALK_TREE_SQL = text('''
+        WITH RECURSIVE walk(src, dst, depth) AS (
+            SELECT source_address, destination_address, 1
+            FROM flows
+            WHERE protocol = :protocol
+              AND destination_port = :port
+              AND source_address = :root
+              AND start >= :start
+            UNION
+            SELECT f.source_address, f.destination_address, w.depth + 1
+            FROM flows f
+            JOIN walk w ON f.source_address = w.dst
+            WHERE f.protocol = :protocol
+              AND f.destination_port = :port
+              AND f.start >= :start
+              AND w.depth < :max_depth
+        )
+        SELECT DISTINCT src, dst FROM walk
+    ''')
+
+    def walk_tree(self, protocol, port, root, start):
         '''
-            Deeper searches of interesting flows.
+            Walks the whole child flow tree in the database, returning the
+            distinct (source, destination) edges in one round trip.
         '''
 
-        return self.session.query(Flow).filter(
-            and_(
-                Flow.protocol == protocol,
-                Flow.destination_port == port,
-                Flow.source_address == source_address,
-                Flow.start >= start#,
-                #Flow.end <= end
-            )
-        )
\ No newline at end of file
+        with self.engine.connect() as connection:
+            return connection.execute(
+                self.WALK_TREE_SQL,
+                {
+                    'protocol': protocol,
+                    'port': port,
+                    'root': root,
+                    'start': start,
+                    'max_depth': self.MAX_WALK_DEPTH
+                }
+            ).fetchall()
\ No newline at end of file